@@ -1,25 +1,30 @@
-import math
 import datetime as dt
+from functools import lru_cache
 from io import BytesIO
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 from PIL import Image
 
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, PatternFill
-from openpyxl.worksheet.datavalidation import DataValidation
-from openpyxl.utils import get_column_letter
+import xlsxwriter
 
 
 # =========================
 # CONFIG
 # =========================
+# default di pandas 3, attivati anche su pandas 2.x:
+# - Copy-on-Write: le copie superficiali non duplicano i dati
+# - stringhe Arrow (pyarrow arriva con streamlit): niente colonne object di str Python
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+    pd.set_option("future.infer_string", True)
+
 st.set_page_config(page_title="SupplyChain AI Starter Kit", layout="wide")
 
-st.markdown(
-    """
+# CSS statico: emesso insieme all'header in un'unica st.markdown
+APP_CSS = """
 <style>
 .block-container {padding-top: 1.2rem; padding-bottom: 2rem;}
 
@@ -85,9 +90,7 @@ st.markdown(
 
 .small-note{ color:#6b7280; font-size:0.88rem; margin-top:6px; }
 </style>
-""",
-    unsafe_allow_html=True,
-)
+"""
 
 # =========================
 # COLONNE
@@ -110,125 +113,181 @@ OPTIONAL_DEFAULTS = {
 
 TEMPLATE_HEADERS = REQUIRED_COLS + list(OPTIONAL_DEFAULTS.keys())
 
+CSV_SEPARATORS = (";", ",", "\t", "|")
+
 
 # =========================
 # HELPERS
 # =========================
+@lru_cache(maxsize=64)
 def business_days_in_month(year: int, month: int) -> int:
     start = dt.date(year, month, 1)
     end = dt.date(year + 1, 1, 1) if month == 12 else dt.date(year, month + 1, 1)
-    cur, count = start, 0
-    while cur < end:
-        if cur.weekday() < 5:
-            count += 1
-        cur += dt.timedelta(days=1)
-    return count
-
-
-def load_data(file) -> pd.DataFrame:
-    if file.name.lower().endswith(".csv"):
-        df = pd.read_csv(file, sep=None, engine="python")
+    # lun–ven, fine esclusa
+    return int(np.busday_count(start, end))
+
+
+def sniff_separator(head: bytes) -> str:
+    # separatore più frequente nella riga di intestazione (i dati possono avere virgole decimali)
+    header = head.splitlines()[0] if head else b""
+    return max(CSV_SEPARATORS, key=lambda s: header.count(s.encode()))
+
+
+def load_data(file_bytes: bytes, filename: str) -> pd.DataFrame:
+    # bytes + nome (hashabili) invece del file caricato: chiave stabile per run_pipeline
+    if filename.lower().endswith(".csv"):
+        sep = sniff_separator(file_bytes[:4096])
+        # parser Arrow (C++, multi-thread); ripiegano sul parser C come prima:
+        # righe irregolari, testo non UTF-8 (colonne binarie -> object), colonne
+        # che Arrow legge come date/orari (il parser C le lascia testo) e intestazioni
+        # duplicate (il parser C le rinomina "note", "note.1")
+        try:
+            df = pd.read_csv(BytesIO(file_bytes), sep=sep, engine="pyarrow")
+            # dtype testati uno per uno: select_dtypes("object") su pandas 3 include anche le str
+            if df.columns.duplicated().any() or any(
+                t == object or pd.api.types.is_datetime64_any_dtype(t) or pd.api.types.is_timedelta64_dtype(t)
+                for t in df.dtypes
+            ):
+                raise ValueError("colonne non testuali/numeriche")
+        except (ImportError, ValueError):
+            df = pd.read_csv(BytesIO(file_bytes), sep=sep, engine="c")
     else:
-        df = pd.read_excel(file)
+        # calamine (Rust, anche .xls) se disponibile, altrimenti reader di default
+        try:
+            df = pd.read_excel(BytesIO(file_bytes), engine="calamine")
+        except (ImportError, ValueError):
+            df = pd.read_excel(BytesIO(file_bytes))
     df.columns = [str(c).strip().lower() for c in df.columns]
-    df = df.loc[:, ~df.columns.str.contains("^unnamed", case=False, na=False)]
+    # colonne senza intestazione: "Unnamed: n" (Excel / parser C) o "" (parser Arrow)
+    unnamed = df.columns.str.startswith("unnamed") | (df.columns == "")
+    if unnamed.any():
+        df = df.loc[:, ~unnamed]
     return df
 
 
 def validate_columns(df: pd.DataFrame):
-    return [c for c in REQUIRED_COLS if c not in df.columns]
+    cols = set(df.columns)
+    return [c for c in REQUIRED_COLS if c not in cols]
+
+
+CRIT_ALIASES = {"alto": "alta", "medio": "media", "basso": "bassa"}
+SEASON_ALIASES = {"sì": "si", "yes": "si", "y": "si", "true": "si", "1": "si"}
+SERVICE_ALIASES = {"high": "alto", "medium": "medio", "low": "basso"}
+
+
+def normalize_labels(s: pd.Series, aliases: dict, allowed=None, default=None) -> pd.Series:
+    # minuscolo/strip/alias solo sui valori distinti, poi rimappa i codici -> Categorical
+    codes, uniques = pd.factorize(s)
+    labels = [str(u).strip().lower() for u in uniques]
+    labels = [aliases.get(v, v) for v in labels]
+    if allowed is None:
+        categories = list(dict.fromkeys(labels))
+        missing = -1
+    else:
+        labels = [v if v in allowed else default for v in labels]
+        categories = list(allowed)
+        missing = categories.index(default)
+    pos = {c: i for i, c in enumerate(categories)}
+    # l'ultimo elemento serve ai codici -1 (celle vuote)
+    lookup = np.array([pos[v] for v in labels] + [missing], dtype=np.intp)
+    return pd.Series(pd.Categorical.from_codes(lookup[codes], categories=categories), index=s.index)
 
 
 def normalize_df(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.copy()
+    df = df.copy(deep=False)
 
     # aggiungi opzionali se mancano
+    cols = set(df.columns)
     for k, v in OPTIONAL_DEFAULTS.items():
-        if k not in df.columns:
+        if k not in cols:
             df[k] = v
 
-    # criticità
-    df["criticita"] = df["criticita"].astype(str).str.lower().str.strip()
-    df["criticita"] = df["criticita"].replace({"alto": "alta", "medio": "media", "basso": "bassa"})
+    # criticità (valori non previsti restano com'erano, ripuliti; celle vuote restano NaN
+    # e la riga cade nel dropna sulle obbligatorie, come con pandas 3 anche in origine)
+    df["criticita"] = normalize_labels(df["criticita"], CRIT_ALIASES)
 
     # stagionale
-    df["stagionale"] = df["stagionale"].astype(str).str.lower().str.strip()
-    df["stagionale"] = df["stagionale"].replace({"sì": "si", "yes": "si", "y": "si", "true": "si", "1": "si"})
-    df.loc[~df["stagionale"].isin(["si", "no"]), "stagionale"] = "no"
+    df["stagionale"] = normalize_labels(df["stagionale"], SEASON_ALIASES, allowed=["si", "no"], default="no")
 
     # livello servizio
-    df["livello_servizio"] = df["livello_servizio"].astype(str).str.lower().str.strip()
-    df["livello_servizio"] = df["livello_servizio"].replace({"high": "alto", "medium": "medio", "low": "basso"})
-    df.loc[~df["livello_servizio"].isin(["alto", "medio", "basso"]), "livello_servizio"] = "medio"
+    df["livello_servizio"] = normalize_labels(
+        df["livello_servizio"], SERVICE_ALIASES, allowed=["basso", "medio", "alto"], default="medio"
+    )
 
-    # numeri
-    for c in ["consumo_mensile", "lead_time_giorni", "stock_attuale", "valore_unitario", "indice_rotazione", "deviazione_standard"]:
-        df[c] = pd.to_numeric(df[c], errors="coerce")
+    # numeri (solo le colonne che il reader non ha già letto come numeriche)
+    num_cols = ["consumo_mensile", "lead_time_giorni", "stock_attuale", "valore_unitario", "indice_rotazione", "deviazione_standard"]
+    to_coerce = [c for c in num_cols if not pd.api.types.is_numeric_dtype(df[c])]
+    if to_coerce:
+        df[to_coerce] = df[to_coerce].apply(pd.to_numeric, errors="coerce")
 
     # righe valide
     df = df.dropna(subset=REQUIRED_COLS)
     return df
 
 
-def z_from_service(level: str) -> float:
-    return {"basso": 1.04, "medio": 1.65, "alto": 2.05}.get(level, 1.65)
+Z_BY_SERVICE = {"basso": 1.04, "medio": 1.65, "alto": 2.05}
+CRIT_FACTOR = {"bassa": 0.9, "media": 1.0, "alta": 1.1}
 
 
-def crit_factor(crit: str) -> float:
-    return {"bassa": 0.9, "media": 1.0, "alta": 1.1}.get(crit, 1.0)
+# fattori calcolati per colonna (lookup/confronti vettoriali, nessuna chiamata per riga)
+def z_from_service(levels: pd.Series) -> pd.Series:
+    return levels.map(Z_BY_SERVICE).astype(np.float64).fillna(1.65)
 
 
-def rotation_factor(rot: float) -> float:
-    if pd.isna(rot):
-        return 1.0
-    if rot >= 12:
-        return 1.10
-    if rot >= 6:
-        return 1.00
-    return 0.90
+def crit_factor(crit: pd.Series) -> pd.Series:
+    return crit.map(CRIT_FACTOR).astype(np.float64).fillna(1.0)
 
 
-def season_factor(stagionale: str) -> float:
-    return 1.15 if stagionale == "si" else 1.00
+def rotation_factor(rot: pd.Series) -> np.ndarray:
+    return np.select([rot.isna(), rot >= 12, rot >= 6], [1.0, 1.10, 1.00], default=0.90)
 
 
-def compute_metrics(df: pd.DataFrame, workdays: int) -> pd.DataFrame:
-    out = df.copy()
+def season_factor(stagionale: pd.Series) -> np.ndarray:
+    return np.where(stagionale == "si", 1.15, 1.00)
 
-    out["consumo_giornaliero"] = out["consumo_mensile"] / float(workdays)
-    out["domanda_lt"] = out["consumo_giornaliero"] * out["lead_time_giorni"]
 
-    # deviazione_standard: mensile -> giornaliera su giorni lavorativi
-    out["sigma_daily"] = out["deviazione_standard"] / math.sqrt(workdays)
-    out["sqrt_lt"] = out["lead_time_giorni"].apply(lambda x: math.sqrt(max(float(x), 0.0)))
+# % di domanda_lt usata come scorta quando manca deviazione_standard (default 0.15)
+FALLBACK_SS_PCT = {"alta": 0.50, "media": 0.30, "bassa": 0.15}
 
-    out["z"] = out["livello_servizio"].apply(z_from_service)
-    out["ss_base"] = out["z"] * out["sigma_daily"] * out["sqrt_lt"]
+# classi di rischio stockout, dalla più urgente
+RISK_LEVELS = ["alto", "medio", "basso"]
 
-    out["fatt_stag"] = out["stagionale"].apply(season_factor)
-    out["fatt_rot"] = out["indice_rotazione"].apply(rotation_factor)
-    out["fatt_crit"] = out["criticita"].apply(crit_factor)
 
-    def ss_final(row):
-        # fallback se deviazione_standard non presente
-        if pd.isna(row["deviazione_standard"]) or pd.isna(row["sigma_daily"]):
-            base_pct = 0.50 if row["criticita"] == "alta" else 0.30 if row["criticita"] == "media" else 0.15
-            return row["domanda_lt"] * base_pct * row["fatt_stag"] * row["fatt_rot"]
-        return max(0.0, row["ss_base"] * row["fatt_stag"] * row["fatt_rot"] * row["fatt_crit"])
+def compute_metrics(df: pd.DataFrame, workdays: int) -> pd.DataFrame:
+    out = df.copy(deep=False)
 
-    out["scorta_sicurezza"] = out.apply(ss_final, axis=1)
+    out["consumo_giornaliero"] = out["consumo_mensile"] / float(workdays)
+    out["domanda_lt"] = out["consumo_giornaliero"] * out["lead_time_giorni"]
 
-    out["punto_riordino"] = (out["domanda_lt"] + out["scorta_sicurezza"]).apply(lambda x: int(math.ceil(x)))
-    out["qty_suggerita"] = (out["punto_riordino"] - out["stock_attuale"]).clip(lower=0).apply(lambda x: int(math.ceil(x)))
+    # deviazione_standard: mensile -> giornaliera su giorni lavorativi
+    out["sigma_daily"] = out["deviazione_standard"] / np.sqrt(workdays)
+    out["sqrt_lt"] = np.sqrt(np.maximum(out["lead_time_giorni"].to_numpy(dtype=np.float64), 0.0))
 
-    def risk(r):
-        if r["stock_attuale"] < r["domanda_lt"]:
-            return "alto"
-        if r["stock_attuale"] < r["punto_riordino"]:
-            return "medio"
-        return "basso"
+    out["z"] = z_from_service(out["livello_servizio"])
+    out["ss_base"] = out["z"] * out["sigma_daily"] * out["sqrt_lt"]
 
-    out["rischio_stockout"] = out.apply(risk, axis=1)
+    out["fatt_stag"] = season_factor(out["stagionale"])
+    out["fatt_rot"] = rotation_factor(out["indice_rotazione"])
+    out["fatt_crit"] = crit_factor(out["criticita"])
+
+    # fallback se deviazione_standard non presente
+    no_sigma = out["deviazione_standard"].isna() | out["sigma_daily"].isna()
+    base_pct = out["criticita"].map(FALLBACK_SS_PCT).astype(np.float64).fillna(0.15)
+    ss_fallback = out["domanda_lt"] * base_pct * out["fatt_stag"] * out["fatt_rot"]
+    ss_sigma = (out["ss_base"] * out["fatt_stag"] * out["fatt_rot"] * out["fatt_crit"]).clip(lower=0.0)
+    out["scorta_sicurezza"] = ss_fallback.where(no_sigma, ss_sigma)
+
+    out["punto_riordino"] = np.ceil(out["domanda_lt"] + out["scorta_sicurezza"]).astype(np.int64)
+    out["qty_suggerita"] = np.ceil((out["punto_riordino"] - out["stock_attuale"]).clip(lower=0)).astype(np.int64)
+
+    # codici 0=alto, 1=medio, 2=basso -> Categorical ordinato senza stringhe per riga
+    stock = out["stock_attuale"].to_numpy(dtype=np.float64)
+    code = np.where(
+        stock < out["domanda_lt"].to_numpy(),
+        0,
+        np.where(stock < out["punto_riordino"].to_numpy(), 1, 2),
+    ).astype(np.int8)
+    out["rischio_stockout"] = pd.Categorical.from_codes(code, categories=RISK_LEVELS, ordered=True)
 
     out["valore_unitario"] = out["valore_unitario"].round(2)
     out["valore_ordine_suggerito"] = (out["qty_suggerita"] * out["valore_unitario"]).round(2)
@@ -237,32 +296,47 @@ def compute_metrics(df: pd.DataFrame, workdays: int) -> pd.DataFrame:
     return out
 
 
-def genera_prompt(row: pd.Series, year: int, month: int, workdays: int) -> str:
-    return f"""
+# cache condivisa da tutte le sessioni: poche voci (file × giorni lavorativi), le più vecchie escono
+@st.cache_data(show_spinner=False, max_entries=16)
+def run_pipeline(file_bytes: bytes, filename: str, workdays: int):
+    # load -> validate -> normalize -> metrics in un'unica voce di cache (bytes + giorni lavorativi):
+    # i rerun dei widget non rifanno parsing né calcoli
+    df_raw = load_data(file_bytes, filename)
+    missing = validate_columns(df_raw)
+    if missing:
+        return missing, None, None
+
+    df = normalize_df(df_raw)
+    if df.empty:
+        return missing, df, None
+    return missing, df, compute_metrics(df, workdays)
+
+
+PROMPT_TEMPLATE = """
 Agisci come responsabile supply chain di una PMI.
 
 Mese: {month:02d}/{year} (giorni lavorativi lun–ven: {workdays})
 
-Articolo: {row['articolo']}
-Consumo mensile: {int(row['consumo_mensile'])}
-Lead time (giorni): {int(row['lead_time_giorni'])}
-Stock attuale: {int(row['stock_attuale'])}
-Criticità: {row['criticita']}
-Valore unitario (€): {row['valore_unitario']:.2f}
+Articolo: {articolo}
+Consumo mensile: {consumo_mensile}
+Lead time (giorni): {lead_time_giorni}
+Stock attuale: {stock_attuale}
+Criticità: {criticita}
+Valore unitario (€): {valore_unitario:.2f}
 
 Parametri avanzati:
-- Stagionale: {row.get('stagionale', 'no')}
-- Indice rotazione: {row.get('indice_rotazione', '')}
-- Deviazione standard (mensile): {row.get('deviazione_standard', '')}
-- Livello servizio: {row.get('livello_servizio', 'medio')}
+- Stagionale: {stagionale}
+- Indice rotazione: {indice_rotazione}
+- Deviazione standard (mensile): {deviazione_standard}
+- Livello servizio: {livello_servizio}
 
 Risultati:
-- Domanda su lead time: {row['domanda_lt']:.2f}
-- Scorta sicurezza: {row['scorta_sicurezza']:.2f}
-- Punto riordino: {int(row['punto_riordino'])}
-- Qty suggerita: {int(row['qty_suggerita'])}
-- Valore ordine suggerito (€): {row['valore_ordine_suggerito']:.2f}
-- Rischio stockout: {row['rischio_stockout']}
+- Domanda su lead time: {domanda_lt:.2f}
+- Scorta sicurezza: {scorta_sicurezza:.2f}
+- Punto riordino: {punto_riordino}
+- Qty suggerita: {qty_suggerita}
+- Valore ordine suggerito (€): {valore_ordine_suggerito:.2f}
+- Rischio stockout: {rischio_stockout}
 
 Richiesta:
 1) Dimmi se riordinare o no e perché (pratico e sintetico).
@@ -270,48 +344,121 @@ Richiesta:
 3) Suggerisci 2 azioni immediate per ridurre rischio stockout.
 """.strip()
 
+PROMPT_DEFAULTS = {"stagionale": "no", "indice_rotazione": "", "deviazione_standard": "", "livello_servizio": "medio"}
+PROMPT_INT_FIELDS = ("consumo_mensile", "lead_time_giorni", "stock_attuale", "punto_riordino", "qty_suggerita")
+
+
+def genera_prompt(row: pd.Series, year: int, month: int, workdays: int) -> str:
+    # una sola conversione Series -> dict invece di un accesso per campo
+    fields = {**PROMPT_DEFAULTS, **row.to_dict(), "year": year, "month": month, "workdays": workdays}
+    for k in PROMPT_INT_FIELDS:
+        fields[k] = int(fields[k])
+    return PROMPT_TEMPLATE.format_map(fields)
+
+
+def articoli_lookup(articoli: pd.Series) -> tuple[list[str], dict[str, int]]:
+    labels = articoli.astype(str).tolist()
+    # posizione della prima occorrenza per etichetta
+    positions = {}
+    for i, a in enumerate(labels):
+        positions.setdefault(a, i)
+    return labels, positions
+
+
+@st.cache_resource(show_spinner=False)
+def hero_image_bytes(path: str, target_height: int) -> bytes:
+    # decodifica + resize una volta per processo, poi PNG già pronto per st.image
+    img = Image.open(path)
+    w, h = img.size
+    ratio = target_height / h
+    new_w = int(w * ratio)
+    buf = BytesIO()
+    img.resize((new_w, target_height)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+# separatori italiani: scambio "," <-> "." in un solo passaggio
+EUR_SEPARATORS = str.maketrans({",": ".", ".": ","})
+
 
 def format_eur(x: float) -> str:
     try:
-        return f"€ {x:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+        return f"€ {x:,.2f}".translate(EUR_SEPARATORS)
     except Exception:
         return "€ 0,00"
 
 
+KPI_CARDS = (
+    ("Articoli caricati", "righe valide nel file"),
+    ("Rischio stockout (alto)", "articoli sotto domanda LT"),
+    ("Capitale immobilizzato", "stock_attuale × valore_unitario"),
+    ("Ordine suggerito (€)", "qty_suggerita × valore_unitario"),
+)
+
+
+@st.cache_data(show_spinner=False)
+def kpi_html(items=None, high_risk=None, capital=None, order_eur=None) -> str:
+    # senza valori (nessun file caricato) mostra i segnaposto
+    if items is None:
+        values = ["—"] * len(KPI_CARDS)
+        subs = ["Carica un file"] * len(KPI_CARDS)
+    else:
+        values = [str(items), str(high_risk), format_eur(capital), format_eur(order_eur)]
+        subs = [sub for _, sub in KPI_CARDS]
+    cards = "".join(
+        f'<div class="kpi"><div class="kpi-label">{label}</div>'
+        f'<div class="kpi-value">{value}</div><div class="kpi-sub">{sub}</div></div>'
+        for (label, _), value, sub in zip(KPI_CARDS, values, subs)
+    )
+    return f'<div class="kpi-wrap">{cards}</div>'
+
+
 # =========================
 # EXCEL HELPERS
 # =========================
-HEADER_FILL = PatternFill("solid", fgColor="D9EAF7")
-HEADER_FONT = Font(bold=True)
-CENTER = Alignment(horizontal="center", vertical="center")
-
-
-def _apply_table_header(ws, headers):
-    ws.append(headers)
-    for c in range(1, len(headers) + 1):
-        cell = ws.cell(row=1, column=c)
-        cell.font = HEADER_FONT
-        cell.fill = HEADER_FILL
-        cell.alignment = CENTER
-    ws.freeze_panes = "A2"
-    ws.auto_filter.ref = f"A1:{get_column_letter(len(headers))}1"
-
-
-def _set_column_widths(ws, headers):
-    # larghezze “pronte da PMI”
-    widths = {
-        "articolo": 14,
-        "criticita": 10,
-        "stagionale": 10,
-        "livello_servizio": 14,
-    }
-    for i, h in enumerate(headers, start=1):
-        w = widths.get(h, 16)
-        ws.column_dimensions[get_column_letter(i)].width = w
+# constant_memory: ogni riga completata va su file temporaneo, RAM costante al crescere delle righe
+# (le righe vanno scritte in ordine). Stringhe come testo: nessuna formula/URL dai codici articolo.
+# Date/orari (colonne extra del file caricato) con lo stesso formato che usava openpyxl
+XLSX_OPTIONS = {
+    "constant_memory": True,
+    "strings_to_formulas": False,
+    "strings_to_urls": False,
+    "default_date_format": "yyyy-mm-dd h:mm:ss",
+}
+
+HEADER_FORMAT = {"bold": True, "bg_color": "#D9EAF7"}
+CENTER = {"align": "center", "valign": "vcenter"}
+
+# formati numerici creati una volta per workbook (nome -> formato)
+NUMBER_FORMATS = {"int_fmt": "0", "dec_fmt": "0.00"}
+
+# larghezze “pronte da PMI”
+COLUMN_WIDTHS = {
+    "articolo": 14,
+    "criticita": 10,
+    "stagionale": 10,
+    "livello_servizio": 14,
+}
+# leggero auto-width su output: 18 per tutte tranne queste
+OUTPUT_COLUMN_WIDTHS = {"articolo": 14, "rischio_stockout": 16}
+OUTPUT_DEFAULT_WIDTH = 18
 
 
-def _format_numeric_columns(ws, headers, start_row=2, end_row=500):
-    # formattazione numerica
+def _workbook_formats(wb):
+    formats = {name: wb.add_format({"num_format": fmt}) for name, fmt in NUMBER_FORMATS.items()}
+    formats["header"] = wb.add_format({**HEADER_FORMAT, **CENTER})
+    formats["note_header"] = wb.add_format(HEADER_FORMAT)
+    return formats
+
+
+def _apply_table_header(ws, headers, formats):
+    ws.write_row(0, 0, headers, formats["header"])
+    ws.freeze_panes(1, 0)
+    ws.autofilter(0, 0, 0, len(headers) - 1)
+
+
+def _number_styles(headers):
+    # formattazione numerica (None = nessun formato)
     int_cols = {
         "consumo_mensile",
         "lead_time_giorni",
@@ -334,65 +481,77 @@ def _format_numeric_columns(ws, headers, start_row=2, end_row=500):
         "indice_rotazione",
     }
 
-    for col_idx, h in enumerate(headers, start=1):
-        col_letter = get_column_letter(col_idx)
+    styles = []
+    for h in headers:
         if h in int_cols:
-            fmt = "0"
+            styles.append("int_fmt")
         elif h in money_cols:
-            fmt = "0.00"
+            styles.append("dec_fmt")
         elif h in float_cols:
-            fmt = "0.00"
+            styles.append("dec_fmt")
         else:
-            continue
+            styles.append(None)
+    return styles
+
+
+def _set_columns(ws, headers, formats, widths=COLUMN_WIDTHS, default_width=16):
+    # larghezza + formato numerico per colonna in un solo passaggio:
+    # xlsxwriter applica il formato a ogni cella della colonna scritta senza formato proprio
+    for i, (h, style) in enumerate(zip(headers, _number_styles(headers))):
+        ws.set_column(i, i, widths.get(h, default_width), formats.get(style))
+
+
+def _sheet_rows(df: pd.DataFrame):
+    # NaN/NA -> None in un solo passaggio: la cella resta vuota
+    return df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+
+
+def _write_rows(ws, rows):
+    for r, values in enumerate(rows, start=1):
+        ws.write_row(r, 0, values)
 
-        for r in range(start_row, end_row + 1):
-            ws[f"{col_letter}{r}"].number_format = fmt
 
+# righe di input coperte dai dropdown nel template (header escluso)
+VALIDATION_ROWS = 499
 
-def _add_validations(ws, headers):
+
+def _add_list_validation(ws, headers, col_name, values, n_rows):
+    col = headers.index(col_name)
+    ws.data_validation(1, col, n_rows, col, {"validate": "list", "source": values})
+
+
+def _add_validations(ws, headers, n_rows=VALIDATION_ROWS):
     # dropdown stagionale si/no
     if "stagionale" in headers:
-        col = get_column_letter(headers.index("stagionale") + 1)
-        dv = DataValidation(type="list", formula1='"si,no"', allow_blank=True)
-        ws.add_data_validation(dv)
-        dv.add(f"{col}2:{col}500")
+        _add_list_validation(ws, headers, "stagionale", ["si", "no"], n_rows)
 
     # dropdown livello_servizio
     if "livello_servizio" in headers:
-        col = get_column_letter(headers.index("livello_servizio") + 1)
-        dv = DataValidation(type="list", formula1='"basso,medio,alto"', allow_blank=True)
-        ws.add_data_validation(dv)
-        dv.add(f"{col}2:{col}500")
+        _add_list_validation(ws, headers, "livello_servizio", ["basso", "medio", "alto"], n_rows)
 
     # dropdown criticita (utile in input)
     if "criticita" in headers:
-        col = get_column_letter(headers.index("criticita") + 1)
-        dv = DataValidation(type="list", formula1='"bassa,media,alta"', allow_blank=True)
-        ws.add_data_validation(dv)
-        dv.add(f"{col}2:{col}500")
+        _add_list_validation(ws, headers, "criticita", ["bassa", "media", "alta"], n_rows)
 
 
+@st.cache_data(show_spinner=False)
 def build_template_xlsx() -> bytes:
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Input"
+    buf = BytesIO()
+    wb = xlsxwriter.Workbook(buf, XLSX_OPTIONS)
+    formats = _workbook_formats(wb)
+    ws = wb.add_worksheet("Input")
 
     headers = TEMPLATE_HEADERS
-    _apply_table_header(ws, headers)
-    _set_column_widths(ws, headers)
+    _apply_table_header(ws, headers, formats)
+    _set_columns(ws, headers, formats)
     _add_validations(ws, headers)
 
     # riga esempio
-    ws.append(["A001", 100, 10, 20, "alta", 10.50, "no", 8, 15, "medio"])
-    _format_numeric_columns(ws, headers, start_row=2, end_row=500)
+    _write_rows(ws, [("A001", 100, 10, 20, "alta", 10.50, "no", 8, 15, "medio")])
 
     # NOTE sheet
-    ws2 = wb.create_sheet("Note")
-    ws2.append(["Campo", "Descrizione"])
-    ws2.cell(1, 1).font = HEADER_FONT
-    ws2.cell(1, 2).font = HEADER_FONT
-    ws2.cell(1, 1).fill = HEADER_FILL
-    ws2.cell(1, 2).fill = HEADER_FILL
+    ws2 = wb.add_worksheet("Note")
+    ws2.write_row(0, 0, ["Campo", "Descrizione"], formats["note_header"])
 
     notes = [
         ("consumo_mensile", "Quantità mensili (unità)."),
@@ -402,51 +561,41 @@ def build_template_xlsx() -> bytes:
         ("livello_servizio", "basso/medio/alto → Z-score per scorta di sicurezza."),
         ("criticita", "bassa/media/alta → micro-fattore correttivo scorta."),
     ]
-    for r in notes:
-        ws2.append(list(r))
-    ws2.column_dimensions["A"].width = 22
-    ws2.column_dimensions["B"].width = 90
+    _write_rows(ws2, notes)
+    ws2.set_column(0, 0, 22)
+    ws2.set_column(1, 1, 90)
 
-    buf = BytesIO()
-    wb.save(buf)
+    wb.close()
     return buf.getvalue()
 
 
+# stesse voci di run_pipeline (una per risultato), stesso limite
+@st.cache_data(show_spinner=False, max_entries=16)
 def build_results_xlsx(df_input: pd.DataFrame, df_output: pd.DataFrame) -> bytes:
-    wb = Workbook()
+    buf = BytesIO()
+    wb = xlsxwriter.Workbook(buf, XLSX_OPTIONS)
+    formats = _workbook_formats(wb)
 
     # INPUT
-    ws_in = wb.active
-    ws_in.title = "Input"
+    ws_in = wb.add_worksheet("Input")
 
     input_headers = TEMPLATE_HEADERS
-    _apply_table_header(ws_in, input_headers)
-    _set_column_widths(ws_in, input_headers)
-    _add_validations(ws_in, input_headers)
-
-    for _, row in df_input.reindex(columns=input_headers).iterrows():
-        ws_in.append(row.tolist())
-    _format_numeric_columns(ws_in, input_headers, start_row=2, end_row=max(2, 1 + len(df_input)))
+    _apply_table_header(ws_in, input_headers, formats)
+    _set_columns(ws_in, input_headers, formats)
+    # dropdown su tutte le righe caricate, con almeno lo spazio del template
+    _add_validations(ws_in, input_headers, max(VALIDATION_ROWS, len(df_input)))
+    _write_rows(ws_in, _sheet_rows(df_input.reindex(columns=input_headers)))
 
     # OUTPUT
-    ws_out = wb.create_sheet("Output")
+    ws_out = wb.add_worksheet("Output")
 
     output_headers = list(df_output.columns)
-    _apply_table_header(ws_out, output_headers)
-    _set_column_widths(ws_out, output_headers)
-
-    for _, row in df_output.iterrows():
-        ws_out.append(row.tolist())
+    _apply_table_header(ws_out, output_headers, formats)
 
-    _format_numeric_columns(ws_out, output_headers, start_row=2, end_row=max(2, 1 + len(df_output)))
+    _set_columns(ws_out, output_headers, formats, OUTPUT_COLUMN_WIDTHS, OUTPUT_DEFAULT_WIDTH)
+    _write_rows(ws_out, _sheet_rows(df_output))
 
-    # leggero auto-width su output
-    for i, h in enumerate(output_headers, start=1):
-        if h not in ("articolo", "rischio_stockout"):
-            ws_out.column_dimensions[get_column_letter(i)].width = 18
-
-    buf = BytesIO()
-    wb.save(buf)
+    wb.close()
     return buf.getvalue()
 
 
@@ -454,7 +603,8 @@ def build_results_xlsx(df_input: pd.DataFrame, df_output: pd.DataFrame) -> bytes
 # HEADER ENTERPRISE
 # =========================
 st.markdown(
-    """
+    APP_CSS
+    + """
 <div class="enterprise-bar">
   <div class="brand">
     <div class="logo">SC</div>
@@ -501,14 +651,8 @@ with right:
     with st.container(border=True):
         img_path = Path("assets/logistic_manager_future.png")
         if img_path.exists():
-            img = Image.open(img_path)
-            target_height = 220
-            w, h = img.size
-            ratio = target_height / h
-            new_w = int(w * ratio)
-            img_resized = img.resize((new_w, target_height))
             st.markdown("<div class='img-box'>", unsafe_allow_html=True)
-            st.image(img_resized)
+            st.image(hero_image_bytes(str(img_path), 220))
             st.markdown("</div>", unsafe_allow_html=True)
         else:
             st.warning("Immagine non trovata: assets/logistic_manager_future.png")
@@ -550,36 +694,22 @@ st.sidebar.caption("Opzionali: stagionale (si/no), indice_rotazione, deviazione_
 st.markdown("### KPI sintetici")
 
 if not uploaded:
-    st.markdown(
-        """
-<div class="kpi-wrap">
-  <div class="kpi"><div class="kpi-label">Articoli caricati</div><div class="kpi-value">—</div><div class="kpi-sub">Carica un file</div></div>
-  <div class="kpi"><div class="kpi-label">Rischio stockout (alto)</div><div class="kpi-value">—</div><div class="kpi-sub">Carica un file</div></div>
-  <div class="kpi"><div class="kpi-label">Capitale immobilizzato</div><div class="kpi-value">—</div><div class="kpi-sub">Carica un file</div></div>
-  <div class="kpi"><div class="kpi-label">Ordine suggerito (€)</div><div class="kpi-value">—</div><div class="kpi-sub">Carica un file</div></div>
-</div>
-""",
-        unsafe_allow_html=True,
-    )
+    st.markdown(kpi_html(), unsafe_allow_html=True)
     st.info("Carica un file per visualizzare analisi e KPI.")
     st.stop()
 
 # =========================
 # PROCESSING
 # =========================
-df_raw = load_data(uploaded)
-missing = validate_columns(df_raw)
+missing, df, metrics = run_pipeline(uploaded.getvalue(), uploaded.name, workdays)
 if missing:
     st.error(f"Colonne mancanti: {missing}")
     st.stop()
 
-df = normalize_df(df_raw)
 if df.empty:
     st.error("Nessuna riga valida trovata. Controlla intestazioni e valori numerici.")
     st.stop()
 
-metrics = compute_metrics(df, workdays)
-
 # =========================
 # KPI CALCOLATI
 # =========================
@@ -589,30 +719,7 @@ capital_locked = float(metrics["capitale_immobilizzato"].sum())
 order_suggested_eur = float(metrics["valore_ordine_suggerito"].sum())
 
 st.markdown(
-    f"""
-<div class="kpi-wrap">
-  <div class="kpi">
-    <div class="kpi-label">Articoli caricati</div>
-    <div class="kpi-value">{items_count}</div>
-    <div class="kpi-sub">righe valide nel file</div>
-  </div>
-  <div class="kpi">
-    <div class="kpi-label">Rischio stockout (alto)</div>
-    <div class="kpi-value">{high_risk_count}</div>
-    <div class="kpi-sub">articoli sotto domanda LT</div>
-  </div>
-  <div class="kpi">
-    <div class="kpi-label">Capitale immobilizzato</div>
-    <div class="kpi-value">{format_eur(capital_locked)}</div>
-    <div class="kpi-sub">stock_attuale × valore_unitario</div>
-  </div>
-  <div class="kpi">
-    <div class="kpi-label">Ordine suggerito (€)</div>
-    <div class="kpi-value">{format_eur(order_suggested_eur)}</div>
-    <div class="kpi-sub">qty_suggerita × valore_unitario</div>
-  </div>
-</div>
-""",
+    kpi_html(items_count, high_risk_count, capital_locked, order_suggested_eur),
     unsafe_allow_html=True,
 )
 
@@ -634,11 +741,12 @@ st.divider()
 # TOP 10 RISCHIO ALTO
 # =========================
 st.markdown("### Top 10 • Rischio alto")
-top10 = metrics[metrics["rischio_stockout"] == "alto"].copy()
+top10 = metrics[metrics["rischio_stockout"] == "alto"]
 if top10.empty:
     st.info("Nessun articolo in rischio ALTO.")
 else:
-    top10 = top10.sort_values(["valore_ordine_suggerito", "valore_unitario"], ascending=[False, False]).head(10)
+    # selezione parziale dei 10 maggiori, senza ordinare tutti gli articoli a rischio
+    top10 = top10.nlargest(10, ["valore_ordine_suggerito", "valore_unitario"])
     show_cols = [
         "articolo", "consumo_mensile", "lead_time_giorni", "stock_attuale",
         "criticita", "livello_servizio", "stagionale", "indice_rotazione",
@@ -657,7 +765,13 @@ st.dataframe(metrics, use_container_width=True)
 # PROMPT AI
 # =========================
 st.markdown("### Prompt AI decisionale")
-art = st.selectbox("Seleziona articolo", metrics["articolo"].astype(str).tolist())
-row = metrics[metrics["articolo"].astype(str) == art].iloc[0]
+# etichette una volta per upload (file_id cambia a ogni nuovo file; le righe non
+# dipendono dai giorni lavorativi): niente hash di metrics["articolo"] a ogni rerun
+if st.session_state.get("articoli_file_id") != uploaded.file_id:
+    st.session_state["articoli"] = articoli_lookup(metrics["articolo"])
+    st.session_state["articoli_file_id"] = uploaded.file_id
+labels, positions = st.session_state["articoli"]
+art = st.selectbox("Seleziona articolo", labels)
+row = metrics.iloc[positions[art]]
 st.text_area("Prompt pronto (copia e incolla in ChatGPT)", genera_prompt(row, year, month, workdays), height=280)
 